@@ -1,24 +1,74 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import argparse
-import nbformat
-import cairosvg
+import orjson
 from io import BytesIO
-from PIL import Image
-from nbconvert.preprocessors import (TagRemovePreprocessor, Preprocessor)
-from traitlets import Set
-import glob
 import os
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
+from collections import namedtuple
 
 # for image embedding
 import mistune
 from urllib.parse import urlparse
-from lxml import etree
-import base64
+import lxml.html
+import binascii
+import struct
 import re
 
+try:
+    # SIMD-accelerated base64, if available
+    from pybase64 import b64encode_as_string
+except ImportError:
+    def b64encode_as_string(s):
+        return binascii.b2a_base64(s, newline=False).decode('ascii')
+
 # mathjax support for mistune renderers;
 # https://github.com/lepture/mistune-contrib/blob/master/mistune_contrib/math.py
+
+# compiled once at import; the lexers just keep references to these
+_BLOCK_MATH_RE = re.compile(r'^\$\$([^\$]*?)\$\$', re.DOTALL)
+_BLOCK_LATEX_RE = re.compile(
+    r'^\\begin\{([a-z]*\*?)\}(.*?)\\end\{\1\}', re.DOTALL
+)
+_INLINE_MATH_RE = re.compile(r'^\$(.+?)\$')
+_INLINE_TEXT_RE = re.compile(r'^[\s\S]+?(?=[\\<!\[_*`~\$]|https?://| {2,}\n|$)')
+
+# numbered backreferences / conditionals inside a rule's pattern
+_BACKREF_RE = re.compile(r'(?<!\\)((?:\\\\)*)\\(\d+)')
+_CONDREF_RE = re.compile(r'\(\?\((\d+)\)')
+_SCOPED_FLAGS = (('i', re.IGNORECASE), ('m', re.MULTILINE),
+                 ('s', re.DOTALL), ('x', re.VERBOSE))
+
+def _combine_rules(rules, grammar):
+    """Fuses the lexer rules into a single alternation, in rule order.
+
+    Every rule becomes a named group, so the first rule that matches can be
+    read off ``lastgroup``; numbered group references inside each rule are
+    shifted by the number of groups that precede it.
+    """
+    parts = []
+    ngroups = 0
+
+    for key in rules:
+        pattern = getattr(grammar, key)
+        offset = ngroups + 1
+        pat = _BACKREF_RE.sub(
+            lambda m: '{}\\{}'.format(m.group(1), int(m.group(2)) + offset),
+            pattern.pattern
+        )
+        pat = _CONDREF_RE.sub(
+            lambda m: '(?({})'.format(int(m.group(1)) + offset), pat
+        )
+        flags = ''.join(f for f, v in _SCOPED_FLAGS if pattern.flags & v)
+        if flags:
+            pat = '(?{}:{})'.format(flags, pat)
+        parts.append('(?P<{}>{})'.format(key, pat))
+        ngroups += pattern.groups + 1
+
+    return re.compile('|'.join(parts))
+
 class MathBlockMixin(object):
     """Math mixin for BlockLexer, mix this with BlockLexer::
         class MathBlockLexer(MathBlockMixin, BlockLexer):
@@ -27,10 +77,8 @@ class MathBlockMixin(object):
                 self.enable_math()
     """
     def enable_math(self):
-        self.rules.block_math = re.compile(r'^\$\$([^\$]*?)\$\$', re.DOTALL)
-        self.rules.block_latex = re.compile(
-            r'^\\begin\{([a-z]*\*?)\}(.*?)\\end\{\1\}', re.DOTALL
-        )
+        self.rules.block_math = _BLOCK_MATH_RE
+        self.rules.block_latex = _BLOCK_LATEX_RE
         self.default_rules = ['block_math', 'block_latex'] + self.default_rules
 
     def parse_block_math(self, m):
@@ -60,9 +108,9 @@ class MathInlineMixin(object):
                 self.enable_math()
     """
     def enable_math(self):
-        self.rules.math = re.compile(r'^\$(.+?)\$')
-        self.default_rules.insert(0, 'math')
-        self.rules.text = re.compile(r'^[\s\S]+?(?=[\\<!\[_*`~\$]|https?://| {2,}\n|$)')
+        self.rules.math = _INLINE_MATH_RE
+        self.default_rules = ['math'] + self.default_rules
+        self.rules.text = _INLINE_TEXT_RE
 
     def output_math(self, m):
         return self.renderer.math(m.group(1))
@@ -71,6 +119,50 @@ class MathInlineLexer(MathInlineMixin, mistune.InlineLexer):
     def __init__(self, *args, **kwargs):
         super(MathInlineLexer, self).__init__(*args, **kwargs)
         self.enable_math()
+        self._combined_rules = {}
+
+    def output(self, text, rules=None):
+        """
+        Same as InlineLexer.output, but instead of trying the rules one
+        by one, a single combined regex finds the first rule that matches.
+        Only if that rule declines the token (its output is None) do we
+        fall back to trying the rules that follow it.
+        """
+        text = text.rstrip('\n')
+        if not rules:
+            rules = list(self.default_rules)
+
+        if self._in_footnote and 'footnote' in rules:
+            rules.remove('footnote')
+
+        combined = self._combined_rules.get(tuple(rules))
+        if combined is None:
+            combined = _combine_rules(rules, self.rules)
+            self._combined_rules[tuple(rules)] = combined
+
+        output = self.renderer.placeholder()
+
+        while text:
+            out = None
+            cm = combined.match(text)
+
+            if cm is not None:
+                for key in rules[rules.index(cm.lastgroup):]:
+                    m = getattr(self.rules, key).match(text)
+                    if not m:
+                        continue
+                    self.line_match = m
+                    out = getattr(self, 'output_%s' % key)(m)
+                    if out is not None:
+                        break
+
+            if out is None:
+                raise RuntimeError('Infinite loop at: %s' % text)
+
+            output += out
+            text = text[len(m.group(0)):]
+
+        return output
 
 class MathRendererMixin(object):
     def block_math(self, text):
@@ -83,17 +175,21 @@ class MathRendererMixin(object):
         return '$%s$' % text
 
 # auxiliary code for image embedding
+_Cell = namedtuple('_Cell', 'flags text')
+
 class MdRenderer(mistune.Renderer, MathRendererMixin):
     # from https://github.com/lepture/mistune-contrib; under BSD-3
 
-    def get_block(text):
-        type = text[0]
-        p = text.find(':')
-        if p <= 0:
-            return ('', '', '')
-        l = int(text[1:p])
-        t = text[p+1:p+1+l]
-        return (text[p+1+l:], type, t)
+    def get_block(text, pos=0):
+        # reads the block starting at pos and returns the position after it;
+        # walking a cursor avoids copying the rest of the text every time
+        type = text[pos]
+        p = text.find(':', pos)
+        if p <= pos:
+            return (len(text), '', '')
+        l = int(text[pos+1:p])
+        end = p+1+l
+        return (end, type, text[p+1:end])
 
     def newline(self):
         return '\n'
@@ -108,18 +204,19 @@ class MdRenderer(mistune.Renderer, MathRendererMixin):
         return '---\n'
 
     def header(self, text, level, raw=None):
-        return '#'*(level+1) + ' ' + text + '\n\n'
+        return '#'*level + ' ' + text + '\n\n'
 
     def paragraph(self, text):
         return text + '\n\n'
 
     def list(self, text, ordered=True):
         r = ''
-        while text:
-            text, type, t = MdRenderer.get_block(text)
+        pos = 0
+        while pos < len(text):
+            pos, type, t = MdRenderer.get_block(text, pos)
             if type == 'l':
-                r += (ordered and ('# ' + t) or ('* ' + t)) + '\n'
-        return r
+                r += (ordered and ('1. ' + t) or ('* ' + t)) + '\n'
+        return r + '\n'
 
     def list_item(self, text):
         return 'l' + str(len(text)) + ':' + text
@@ -134,7 +231,7 @@ class MdRenderer(mistune.Renderer, MathRendererMixin):
         return r
 
     def _emphasis(self, text, pref):
-        return pref + text + pref + ' '
+        return pref + text + pref
 
     def emphasis(self, text):
         return self._emphasis(text, '*')
@@ -160,76 +257,60 @@ class MdRenderer(mistune.Renderer, MathRendererMixin):
     def image(self, src, title, text):
         self.link(src, title, text, image=True)
 
-    def table(self, header, body):
-        hrows = []
-        while header:
-            header, type1, t = MdRenderer.get_block(header)
+    def _table_rows(self, text):
+        rows = []
+        pos = 0
+        while pos < len(text):
+            pos, type1, t = MdRenderer.get_block(text, pos)
             if type1 == 'r':
                 flags = {}
                 cols = []
-                while t:
-                    t, type2, t2 = MdRenderer.get_block(t)
+                cpos = 0
+                while cpos < len(t):
+                    cpos, type2, t2 = MdRenderer.get_block(t, cpos)
                     if type2 == 'f':
                         fl, v = t2.split('=')
                         flags[fl] = v
                     elif type2 == 'c':
-                        cols.append(type('',(object,),{'flags':flags,'text':t2})())
-                hrows.append(cols)
-        brows = []
-        while body:
-            body, type1, t = MdRenderer.get_block(body)
-            if type1 == 'r':
-                flags = {}
-                cols = []
-                while t:
-                    t, type2, t2 = MdRenderer.get_block(t)
-                    if type2 == 'f':
-                        fl, v = t2.split('=')
-                        flags[fl] = v
-                    elif type2 == 'c':
-                        cols.append(type('',(object,),{'flags':flags,'text':t2})())
-                brows.append(cols)
-        colscount = 0
-        colmax = [0] * 100
-        align = [''] * 100
-        for row in hrows + brows:
-            colscount = max(len(row), colscount)
-            i = 0
-            for col in row:
-                colmax[i] = max(len(col.text), colmax[i])
-                if 'align' in col.flags:
-                    align[i] = col.flags['align'][0]
-                i += 1
-        r = ''
-        for row in hrows:
-            i = 0
-            for col in row:
-                if i > 0:
-                    r += ' | '
-                r += col.text.ljust(colmax[i])
-                i += 1
-            r += '\n'
-        for i in range(colscount):
-            if i > 0:
-                r += ' | '
-            if align[i] == 'c':
-                r += ':' + '-'.ljust(colmax[i]-2, '-') + ':'
-            elif align[i] == 'l':
-                r += ':' + '-'.ljust(colmax[i]-1, '-')
-            elif align[i] == 'r':
-                r +=    '-'.ljust(colmax[i]-1, '-') + ':'
-            else:
-                r += '-'.ljust(colmax[i], '-')
-        r += '\n'
-        for row in brows:
-            i = 0
-            for col in row:
-                if i > 0:
-                    r += ' | '
-                r += col.text.ljust(colmax[i])
-                i += 1
-            r += '\n'
-        return r
+                        cols.append(_Cell(flags, t2))
+                        flags = {}
+                rows.append(cols)
+        return rows
+
+    def _table_rule(self, width, align):
+        if align == 'c':
+            return ':' + '-'.ljust(width-2, '-') + ':'
+        elif align == 'l':
+            return ':' + '-'.ljust(width-1, '-')
+        elif align == 'r':
+            return '-'.ljust(width-1, '-') + ':'
+        else:
+            return '-'.ljust(width, '-')
+
+    def table(self, header, body):
+        hrows = self._table_rows(header)
+        brows = self._table_rows(body)
+
+        # one entry per column, sized to the widest row
+        columns = list(zip_longest(*(hrows + brows), fillvalue=_Cell({}, '')))
+        colmax = [max(len(cell.text) for cell in col) for col in columns]
+        align = [''] * len(columns)
+        for i, col in enumerate(columns):
+            for cell in col:
+                if 'align' in cell.flags:
+                    align[i] = cell.flags['align'][0]
+
+        def format_row(row):
+            return ' | '.join(
+                cell.text.ljust(colmax[i]) for i, cell in enumerate(row)
+            )
+
+        lines = [format_row(row) for row in hrows]
+        lines.append(' | '.join(
+            self._table_rule(w, a) for w, a in zip(colmax, align)
+        ))
+        lines.extend(format_row(row) for row in brows)
+        return '\n'.join(lines) + '\n'
 
     def table_row(self, content):
         return 'r' + str(len(content)) + ':' + content
@@ -271,32 +352,89 @@ class MarkdownWithMath(mistune.Markdown):
     def output_block_latex(self):
         return self.renderer.block_latex(self.token['name'], self.token['text'])
 
+# quick checks for whether a piece of markdown / html includes any images
+_HTML_IMAGE_RE = re.compile(r'<img\b', re.IGNORECASE)
+_MD_IMAGE_RE = re.compile(r'!\[|<img\b', re.IGNORECASE)
+# what can precede the root element of an svg: a BOM, the xml declaration
+# (or other processing instructions), comments, a doctype and whitespace
+_SVG_PROLOG_RE = re.compile(
+    rb'(?:\xef\xbb\xbf)?'
+    rb'(?:\s+|<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^\[>]*(?:\[.*?\])?\s*>)*',
+    re.DOTALL
+)
+# whether the root element of an svg specifies its size
+_SVG_SIZE_RE = re.compile(rb'<svg\b[^>]*?\s(?:width|viewBox)\s*=')
+
+def _svg_has_size(content):
+    root = _SVG_PROLOG_RE.match(content).end()
+    return _SVG_SIZE_RE.match(content, root) is not None
+
+# the same images get embedded once per config (and often by several
+# notebooks), so the encoded data source is cached; the mtime is part
+# of the key so that files modified in the meantime get re-encoded
+@functools.lru_cache(maxsize=None)
+def _encode_image(filepath, mtime, mimetype, convert_svgs):
+    content = None
+
+    if mimetype == 'image/svg+xml' and not convert_svgs:
+        with open(filepath, "rb") as file:
+            content = file.read()
+
+        # svgs that do not declare their size still get rasterized,
+        # since there would be nothing to size the img by
+        if not _svg_has_size(content):
+            content = None
+
+    if mimetype == 'image/svg+xml' and content is None:
+        # cairosvg (and cairo with it) takes a while to load, so it is
+        # only imported once there is an svg to convert
+        import cairosvg
+        out = BytesIO()
+        cairosvg.svg2png(url=filepath, write_to=out, scale=2.5)
+        # a view of the BytesIO buffer, to avoid copying the png
+        content = out.getbuffer()
+        # the size is in the IHDR chunk, right after the 8-byte signature
+        # and the chunk's length/type fields; no need to decode the image
+        w, h = struct.unpack(">II", content[16:24])
+        width = int(w / 2.5)
+        height = int(h / 2.5)
+        mimetype = 'image/png'
+    else:
+        if content is None:
+            with open(filepath, "rb") as file:
+                content = file.read()
+        width = None
+        height = None
+
+    enc = b64encode_as_string(content)
+    # join sizes the result once, without going through the format machinery
+    data_src = ''.join(("data:", mimetype, ";base64,", enc))
+
+    return data_src, width, height
+
+_MIME_BY_EXT = {
+    'gif': 'image/gif',
+    'pbm': 'image/x-portable-bitmap',
+    'pgm': 'image/x-portable-graymap',
+    'ppm': 'image/x-portable-pixmap',
+    'tiff': 'image/tiff',
+    'xbm': 'image/x-xbitmap',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'bmp': 'image/x-ms-bmp',
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
 class EmbedImagesRenderer(MdRenderer):
-    outer_tag = re.compile(r'^<[^>]+>(.*?)</[^>]+>$', re.DOTALL)
-    
-    _mime_types = {
-        'gif': 'image/gif',
-        'pbm': 'image/x-portable-bitmap',
-        'pgm': 'image/x-portable-graymap',
-        'ppm': 'image/x-portable-pixmap',
-        'tiff': 'image/tiff',
-        'xbm': 'image/x-xbitmap',
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'bmp': 'image/x-ms-bmp',
-        'png': 'image/png',
-        'svg': 'image/svg+xml',
-    }
-    
     def __init__(self, *args, root_path='.', convert_svgs=True, **kwargs):
         super().__init__(*args, **kwargs)
-        self.parser = etree.HTMLParser()
         self.root_path = root_path
         self.convert_svgs = convert_svgs
         
     def _mime_type(self, fname):
-        img_ext = os.path.splitext(fname)[-1][1:]
-        return self._mime_types.get(img_ext)
+        img_ext = fname.rpartition('.')[2].lower()
+        return _MIME_BY_EXT.get(img_ext)
 
     def _html_image(self, src, title, text, width, height):
         s = '<img src="' + mistune.escape_link(src) + '"'
@@ -327,53 +465,38 @@ class EmbedImagesRenderer(MdRenderer):
 
         if mimetype is None:
             raise ValueError("Mimetype for '{}' unknown.".format(src))
-        elif self.convert_svgs and mimetype == 'image/svg+xml':
-            out = BytesIO()
-            cairosvg.svg2png(url=filepath, write_to=out, scale=2.5)
-            out.seek(0)
-            im = Image.open(out)
-            width = int(im.width / 2.5)
-            height = int(im.height / 2.5)
-            out.seek(0)
-            content = out.read()
-            mimetype = 'image/png'
-        else:
-            with open(filepath, "rb") as file:
-                content = file.read()
-            width = None
-            height = None
-        
-        enc = base64.b64encode(content).decode('utf-8')
-        data_src = "data:{mimetype};base64,{enc}".format(mimetype=mimetype, enc=enc)
-        
-        return data_src, width, height
 
-    def _strip_outer_tag(self, html_fragment):
-        m = self.outer_tag.search(html_fragment)
+        filepath = os.path.abspath(filepath)
+        return _encode_image(filepath, os.path.getmtime(filepath),
+                             mimetype, self.convert_svgs)
 
-        if m is None:
-            return html_fragment
-        else:
-            return m.group(1)
-    
     def _proc_html(self, html):
-        tree = etree.fromstring(html, parser=self.parser)
-        body = tree.find('body')
-        
-        for img in body.findall('.//img'):
-            data_src, width, height = self._to_data_src(img.get('src'))
+        # most html snippets contain no images; leave those untouched
+        if not _HTML_IMAGE_RE.search(html):
+            return html
 
-            if img.get("width") is None and img.get("height") is None:
-                if not width is None:
-                    img.set("width", str(width))
+        fragments = lxml.html.fragments_fromstring(html)
 
-                if not height is None:
-                    img.set("height", str(height))
+        for fragment in fragments:
+            # leading text comes back as a plain string
+            if isinstance(fragment, str): continue
 
-            if data_src: img.set('src', str(data_src))
-            
-        return self._strip_outer_tag(
-            etree.tostring(body, method='html', pretty_print=True).decode('utf-8')
+            for img in fragment.iter('img'):
+                data_src, width, height = self._to_data_src(img.get('src'))
+
+                if img.get("width") is None and img.get("height") is None:
+                    if not width is None:
+                        img.set("width", str(width))
+
+                    if not height is None:
+                        img.set("height", str(height))
+
+                if data_src: img.set('src', data_src)
+
+        return ''.join(
+            fragment if isinstance(fragment, str)
+            else lxml.html.tostring(fragment, encoding='unicode')
+            for fragment in fragments
         )
     
     def image(self, src, title, text):
@@ -392,115 +515,184 @@ class EmbedImagesRenderer(MdRenderer):
         html = self._proc_html(html)
         return super().block_html(html)
 
-class ClearOutputByTagPreprocessor(Preprocessor):
+# metadata associated with the output of a cell
+_OUTPUT_METADATA_FIELDS = ('collapsed', 'scrolled')
+
+def filter_cells(nb, remove_tags, keep_output_tags, clear_outputs):
     """
-    Removes the output from all code cells in a notebook.
+    Removes the cells tagged with any of remove_tags and, if clear_outputs
+    is set, clears the outputs of the code cells that are not tagged with
+    any of keep_output_tags – both in a single pass over the cells.
     """
+    cells = []
 
-    remove_metadata_fields = Set(
-        {'collapsed', 'scrolled'}
-    ).tag(config=True)
+    for cell in nb['cells']:
+        tags = cell.get('metadata', {}).get('tags', ())
+        if not remove_tags.isdisjoint(tags): continue
 
-    def __init__(self, with_tags=None, without_tags=None):
-        self.with_tags = set(with_tags) if not with_tags is None else None
-        self.without_tags = set(without_tags) if not without_tags is None else None
+        if (clear_outputs and cell['cell_type'] == 'code' and
+                keep_output_tags.isdisjoint(tags)):
+            cell['outputs'] = []
+            cell['execution_count'] = None
+            if 'metadata' in cell:
+                for field in _OUTPUT_METADATA_FIELDS:
+                    cell['metadata'].pop(field, None)
 
-    def preprocess_cell(self, cell, resources, cell_index):
-        """
-        Apply a transformation on each cell. See base.py for details.
-        """
-        if cell.cell_type == 'code':
-            tags = set(cell.get('metadata', {}).get('tags', []))
-            if (
-                ((self.with_tags is None) or
-                 len(self.with_tags.intersection(tags)) == len(self.with_tags)) and
-                ((self.without_tags is None) or
-                 len(self.without_tags.intersection(tags)) == 0)
-            ):
-                cell.outputs = []
-                cell.execution_count = None
-                # Remove metadata associated with output
-                if 'metadata' in cell:
-                    for field in self.remove_metadata_fields:
-                        cell.metadata.pop(field, None)
-        return cell, resources
+        cells.append(cell)
+
+    nb['cells'] = cells
 
 #-------------------------------------------------------------------------------
 #                               run the conversion
 #-------------------------------------------------------------------------------
 
-parser = argparse.ArgumentParser(description='Export Notebooks')
-parser.add_argument('-o',
-                    '--outdir',
-                    default="DRIVE_MATERIAL",
-                    help='The root path where to output the exported files.')
-
-parser.add_argument('-s',
-                    '--lab-subdir',
-                    metavar='lab_subdir',
-                    required=True,
-                    help='Path to the directory with the tagged notebooks.' +
-                         'E.g. "L1_python_intro".')
-
-parser.add_argument('-d', '--no-image-embed', dest='embed_images', action='store_false')
-
-args = parser.parse_args()
-lab_subdir = args.lab_subdir
-outdir = args.outdir
-embed_images = args.embed_images
-
-# renderer and markdown parser for embedding images
-if embed_images:
-    renderer = EmbedImagesRenderer(root_path=lab_subdir)
-    mistune_parser = MarkdownWithMath(renderer=renderer,
-                                      inline=MathInlineLexer,
-                                      block=MathBlockLexer)
-
 confs = {
     "STUDENTS_SK": {
-        "remove_tags": ["en", "teacher", "drop"],
+        "remove_tags": frozenset({"en", "teacher", "drop"}),
         "clear_outputs": True
     },
 
     "STUDENTS_EN": {
-        "remove_tags": ["sk", "teacher", "drop"],
+        "remove_tags": frozenset({"sk", "teacher", "drop"}),
         "clear_outputs": True
     },
 
     "TEACHERS_EN": {
-        "remove_tags": ["sk", "student", "drop"],
+        "remove_tags": frozenset({"sk", "student", "drop"}),
         "clear_outputs": False
     }
 }
 
-for conf_name, conf in confs.items():
-    dirpath = os.path.join(outdir, conf_name, lab_subdir)
-    os.makedirs(dirpath, exist_ok=True)
-
-    for nb_fname in glob.iglob(os.path.join(lab_subdir, "*.ipynb")):
-        nb_fbasename = os.path.basename(nb_fname)
-        # skip filenames that start with _
-        if(nb_fbasename[0] == '_'): continue
+# code cells with these tags keep their outputs even when clearing
+keep_output_tags = frozenset({"keep"})
+
+# renderer and markdown parser for embedding images; these are built
+# lazily inside each worker process rather than pickled over to it
+@functools.lru_cache(maxsize=None)
+def get_markdown_parser(root_path, convert_svgs):
+    renderer = EmbedImagesRenderer(root_path=root_path,
+                                   convert_svgs=convert_svgs)
+    return MarkdownWithMath(renderer=renderer,
+                            inline=MathInlineLexer,
+                            block=MathBlockLexer)
+
+# the same markdown cells recur across the configs, so each distinct
+# source only needs to go through the parser once per process
+@functools.lru_cache(maxsize=None)
+def render_markdown(source, root_path, convert_svgs):
+    return get_markdown_parser(root_path, convert_svgs).render(source)
+
+def write_file(path, data):
+    """
+    Writes bytes to a file straight through the file descriptor, without
+    the buffering and encoding layers of a Python file object.
+    """
+    # O_BINARY keeps Windows from translating the newlines
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(path, flags, 0o666)
+
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def process_notebook(nb_fname, lab_subdir, outdir, embed_images, convert_svgs):
+    """
+    Generates all the configs for a single notebook. All configs of
+    a notebook are done by the same worker, so that they share its
+    rendered markdown and encoded images.
+    """
+    nb_fbasename = os.path.basename(nb_fname)
 
-        print("Generating '{}' for notebook '{}'.".format(conf_name, nb_fname))
-        resources = {}
+    with open(nb_fname, 'rb') as file:
+        nb_json = file.read()
 
-        with open(nb_fname, encoding='utf8') as file:
-            notebook = nbformat.read(file, nbformat.NO_CONVERT)
+    for conf_name, conf in confs.items():
+        dirpath = os.path.join(outdir, conf_name, lab_subdir)
 
-        tag_remove = TagRemovePreprocessor(
-            remove_cell_tags=conf["remove_tags"])
-        tag_remove.preprocess(notebook, resources)
+        print("Generating '{}' for notebook '{}'.".format(conf_name, nb_fname))
+        # every config gets a fresh copy of the notebook to modify
+        notebook = orjson.loads(nb_json)
 
-        if conf["clear_outputs"]:
-            clear_preproc = ClearOutputByTagPreprocessor(without_tags=['keep'])
-            clear_preproc.preprocess(notebook, resources)
+        filter_cells(notebook, conf["remove_tags"], keep_output_tags,
+                     conf["clear_outputs"])
 
         if embed_images:
             for cell in notebook['cells']:
                 if cell['cell_type'] == 'markdown':
-                    cell['source'] = mistune_parser.render(cell['source'])
-
-        with open(os.path.join(dirpath, nb_fbasename),
-          'w', encoding='utf-8') as file:
-            nbformat.write(notebook, file)
+                    # on disk, the source is normally split into lines
+                    source = cell['source']
+                    if isinstance(source, list):
+                        source = ''.join(source)
+                    # cells without images do not need to be re-rendered
+                    if not _MD_IMAGE_RE.search(source): continue
+                    source = render_markdown(source, lab_subdir, convert_svgs)
+                    cell['source'] = source.splitlines(True)
+
+        write_file(os.path.join(dirpath, nb_fbasename), orjson.dumps(
+            notebook, option=(orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS |
+                              orjson.OPT_APPEND_NEWLINE)
+        ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export Notebooks')
+    parser.add_argument('-o',
+                        '--outdir',
+                        default="DRIVE_MATERIAL",
+                        help='The root path where to output the exported files.')
+
+    parser.add_argument('-s',
+                        '--lab-subdir',
+                        metavar='lab_subdir',
+                        required=True,
+                        help='Path to the directory with the tagged notebooks.' +
+                             'E.g. "L1_python_intro".')
+
+    parser.add_argument('-d', '--no-image-embed', dest='embed_images', action='store_false')
+
+    parser.add_argument('-k',
+                        '--keep-svgs',
+                        dest='convert_svgs',
+                        action='store_false',
+                        help='Embed SVG images as they are instead of ' +
+                             'converting them to PNG. Note that Google ' +
+                             'Colab does not display embedded SVGs. SVGs ' +
+                             'with no width or viewBox are still converted.')
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=None,
+                        help='The number of worker processes; ' +
+                             'defaults to the number of CPUs.')
+
+    args = parser.parse_args()
+    lab_subdir = args.lab_subdir
+    outdir = args.outdir
+    embed_images = args.embed_images
+    convert_svgs = args.convert_svgs
+
+    for conf_name in confs:
+        dirpath = os.path.join(outdir, conf_name, lab_subdir)
+        os.makedirs(dirpath, exist_ok=True)
+
+    nb_fnames = []
+    with os.scandir(lab_subdir) as entries:
+        for entry in entries:
+            name = entry.name
+            if not name.endswith('.ipynb'): continue
+            # skip filenames that start with _ and hidden files
+            if name.startswith(('_', '.')): continue
+            nb_fnames.append(os.path.join(lab_subdir, name))
+
+    worker = functools.partial(process_notebook,
+                               lab_subdir=lab_subdir,
+                               outdir=outdir,
+                               embed_images=embed_images,
+                               convert_svgs=convert_svgs)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        # consume the results so that exceptions from the workers propagate
+        list(executor.map(worker, nb_fnames))